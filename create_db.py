@@ -7,8 +7,7 @@ def create_table():
     cursor = conn.cursor()
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS processed_vacancies (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            vacancy_id INTEGER NOT NULL UNIQUE,
+            vacancy_id INTEGER PRIMARY KEY,
             processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
@@ -1,15 +1,26 @@
 import os
+import enum
+import re
+import hashlib
+import time
+import random
 import asyncio
-import requests
+import aiohttp
+import orjson
 import logging
 import sqlite3
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO)
+# Аргументы сообщений форматируются лениво, DEBUG-строки при уровне INFO ничего не стоят
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    handlers=[logging.StreamHandler()],
+)
 logger = logging.getLogger(__name__)
 
 # Загружаем переменные из .env
@@ -20,6 +31,15 @@ VACANCY_BASE_URL = os.getenv("VACANCY_BASE_URL", "https://ukrcrewing.com.ua/en/v
 DB_FILE = os.getenv("DB_FILE", "vacancies.db")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 CHECK_INTERVAL = 60  # Интервал автоматической проверки (1 минута для теста, можно поставить 1800 для 30 минут)
+PROBE_BATCH_SIZE = 50  # Сколько ID проверяется за один проход
+PROBE_CONCURRENCY = 10  # Максимум одновременных запросов к ukrcrewing
+MAX_MISSING = 10  # Если подряд не найдено 10 вакансий, останавливаем цикл
+MAX_FAILED_CYCLES = 3  # После стольких циклов с временной ошибкой ID считается отсутствующим
+SCRAPE_TIMEOUT = CHECK_INTERVAL * 10  # Зависшая проверка отменяется по истечении этого времени
+DEEPSEEK_BATCH_SIZE = 5  # Сколько вакансий отправляется в DeepSeek одним запросом
+MAX_TOKENS_PER_VACANCY = 1500
+DEEPSEEK_MAX_TOKENS = 8000  # Предел ответа deepseek-chat
+DEEPSEEK_TIMEOUT_PER_VACANCY = 60  # Секунд на генерацию MAX_TOKENS_PER_VACANCY токенов
 
 # Допустимые названия вакансий и соответствующие ID топиков (нижний регистр)
 TOPIC_ID_MAPPING = {
@@ -42,277 +62,701 @@ TOPIC_ID_MAPPING = {
     "steward": 102
 }
 
+# Все ключевые слова одним регулярным выражением: один проход по строке вместо 17.
+# Длинные варианты идут первыми, чтобы при совпадении в одной позиции побеждал более точный
+TOPIC_PATTERN = re.compile(
+    "|".join(re.escape(keyword) for keyword in sorted(TOPIC_ID_MAPPING, key=len, reverse=True))
+)
+
+# Предварительный отбор по заголовку страницы, до DeepSeek. DeepSeek сам приводит
+# сокращения ("Ch. Engineer", "2nd Eng", "ETO") к нужным названиям, поэтому пропускаем
+# только заголовки, где названа явно посторонняя должность и нет ни одной из наших.
+# Варианты написания тех же должностей на ukrcrewing (нижний регистр)
+TITLE_ALIASES = (
+    "captain", "chief mate", "c/o", "2nd mate", "second mate", "second officer", "2/o",
+    "3rd mate", "third mate", "third officer", "3/o", "c/e", "second engineer", "2/e",
+    "third engineer", "3/e", "fourth engineer", "4/e", "electrician", "eto", "boatswain",
+    "ab", "a/b", "os", "o/s", "oiler", "chief cook", "messman",
+    "officer", "mate", "engineer", "eng", "electro", "seaman"
+)
+# Должности, которые не публикуются ни в одном топике
+UNRELATED_TITLES = (
+    "welder", "cadet", "trainee", "pumpman", "crane operator", "waiter", "waitress",
+    "bartender", "barman", "housekeeper", "cleaner", "laundry", "hairdresser",
+    "massage therapist", "photographer", "nurse", "doctor"
+)
+
+
+def whole_word_pattern(keywords) -> re.Pattern:
+    # Совпадение только по целым словам, чтобы "ab" или "os" не находились внутри других слов
+    return re.compile(
+        r"(?<!\w)(?:"
+        + "|".join(re.escape(keyword) for keyword in sorted(keywords, key=len, reverse=True))
+        + r")(?!\w)"
+    )
+
+
+TITLE_PATTERN = whole_word_pattern((*TOPIC_ID_MAPPING, *TITLE_ALIASES))
+UNRELATED_TITLE_PATTERN = whole_word_pattern(UNRELATED_TITLES)
+
 VACANCY_DELIMITER = "===VACANCY==="
 
 
 ### Работа с SQLite
 
-def get_db_connection():
-    return sqlite3.connect(DB_FILE)
+DB_LOCK = asyncio.Lock()  # sqlite3-соединение не рассчитано на конкурентные записи из корутин
+
+
+def open_db() -> sqlite3.Connection:
+    # Одно соединение на все время работы бота, WAL позволяет читать во время записи
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
 
 
-def create_table():
-    conn = get_db_connection()
+def create_table(conn: sqlite3.Connection):
     cursor = conn.cursor()
+    # Старая схема хранила суррогатный id AUTOINCREMENT и отдельный UNIQUE-индекс по vacancy_id.
+    # Теперь vacancy_id сам является ROWID - одно B-дерево вместо двух и без sqlite_sequence.
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(processed_vacancies)")]
+    migrate = "id" in columns
+    cursor.execute("BEGIN")
+    if migrate:
+        cursor.execute("ALTER TABLE processed_vacancies RENAME TO processed_vacancies_old")
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS processed_vacancies (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            vacancy_id INTEGER NOT NULL UNIQUE,
+            vacancy_id INTEGER PRIMARY KEY,
             processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
-    conn.commit()
-    conn.close()
-    print("Database and table 'processed_vacancies' are ready.")
+    if migrate:
+        cursor.execute("""
+            INSERT INTO processed_vacancies (vacancy_id, processed_at)
+            SELECT vacancy_id, processed_at FROM processed_vacancies_old
+        """)
+        cursor.execute("DROP TABLE processed_vacancies_old")
+        logger.info("Table 'processed_vacancies' migrated to vacancy_id INTEGER PRIMARY KEY.")
+    # Кэш ответов DeepSeek по sha256 сырого текста вакансии
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS formatted_cache (
+            sha TEXT PRIMARY KEY,
+            formatted TEXT NOT NULL,
+            topic INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("COMMIT")
+    logger.info("Database and tables 'processed_vacancies', 'formatted_cache' are ready.")
 
 
-def get_last_processed_id() -> int:
-    conn = get_db_connection()
+def get_last_processed_id(conn: sqlite3.Connection) -> int:
     cursor = conn.cursor()
-    cursor.execute("SELECT MAX(vacancy_id) FROM processed_vacancies")
+    # Берем последний ROWID (vacancy_id) без агрегата
+    cursor.execute("SELECT vacancy_id FROM processed_vacancies ORDER BY vacancy_id DESC LIMIT 1")
     result = cursor.fetchone()
-    conn.close()
     # Если таблица пуста, начинаем с 308351 (начальное значение можно изменить)
-    last_id = result[0] if result[0] is not None else 308420
-    print(f"Last processed vacancy ID: {last_id}")
+    last_id = result[0] if result is not None else 308420
+    logger.info("Last processed vacancy ID: %s", last_id)
     return last_id
 
 
-def save_processed_id(vacancy_id: int):
-    # Сохраняем только те ID, для которых вакансия реально была обработана
-    conn = get_db_connection()
+def save_processed_ids(conn: sqlite3.Connection, vacancy_ids: list):
+    # Сохраняем только те ID, для которых вакансия реально была обработана, одной транзакцией
+    try:
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT OR IGNORE INTO processed_vacancies (vacancy_id) VALUES (?)",
+            [(vacancy_id,) for vacancy_id in vacancy_ids]
+        )
+        conn.execute("COMMIT")
+        logger.info("Saved processed vacancy IDs: %s", vacancy_ids)
+    except Exception as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        logger.error("Error saving vacancy ids %s: %s", vacancy_ids, e)
+
+
+DB_WRITE_QUEUE = asyncio.Queue()  # ID обработанных вакансий, ожидающие записи в базу
+DB_WRITE_BATCH_SIZE = 100
+
+
+async def db_writer(conn: sqlite3.Connection):
+    # Единственный писатель processed_vacancies: собирает накопившиеся ID в пачку
+    # и пишет их в отдельном потоке, чтобы fsync не блокировал event loop
+    while True:
+        batch = [await DB_WRITE_QUEUE.get()]
+        while not DB_WRITE_QUEUE.empty() and len(batch) < DB_WRITE_BATCH_SIZE:
+            batch.append(DB_WRITE_QUEUE.get_nowait())
+        try:
+            async with DB_LOCK:
+                await asyncio.to_thread(save_processed_ids, conn, batch)
+        finally:
+            for _ in batch:
+                DB_WRITE_QUEUE.task_done()
+
+
+def get_cached_format(conn: sqlite3.Connection, sha: str):
     cursor = conn.cursor()
+    cursor.execute("SELECT formatted, topic FROM formatted_cache WHERE sha = ?", (sha,))
+    return cursor.fetchone()
+
+
+def save_cached_formats(conn: sqlite3.Connection, rows: list):
+    # rows - кортежи (sha, formatted, topic), пишутся одной транзакцией
     try:
-        cursor.execute("INSERT OR IGNORE INTO processed_vacancies (vacancy_id) VALUES (?)", (vacancy_id,))
-        conn.commit()
-        print(f"Saved processed vacancy ID: {vacancy_id}")
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT OR REPLACE INTO formatted_cache (sha, formatted, topic) VALUES (?, ?, ?)",
+            rows
+        )
+        conn.execute("COMMIT")
     except Exception as e:
-        logger.error(f"Error saving vacancy id {vacancy_id}: {e}")
-        print(f"Error saving vacancy id {vacancy_id}: {e}")
-    finally:
-        conn.close()
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        logger.error("Error caching %s formatted vacancies: %s", len(rows), e)
+
+
+### Ограничение частоты запросов
+
+class RateLimiter:
+    """Token bucket: не более rate запросов в секунду (с запасом до capacity)."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+SCRAPE_LIMITER = RateLimiter(5)  # ukrcrewing: 5 запросов в секунду
+DEEPSEEK_LIMITER = RateLimiter(2)  # DeepSeek: 2 запроса в секунду
+
+HTTP_RETRIES = 3  # Повторы при временных ошибках (429, 5xx, обрыв соединения)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+async def request_with_retry(session: aiohttp.ClientSession, method: str, url: str,
+                             limiter: RateLimiter, retry_timeouts: bool = True,
+                             **kwargs) -> aiohttp.ClientResponse:
+    # Повторяем запрос с экспоненциальной задержкой и джиттером.
+    # retry_timeouts=False - не повторять запрос, который мог выполниться на сервере (платные вызовы).
+    # Ответ возвращается как есть, вызывающий код закрывает его через "async with".
+    for attempt in range(HTTP_RETRIES + 1):
+        await limiter.acquire()
+        try:
+            response = await session.request(method, url, **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Таймаут на этапе соединения безопасен для повтора: запрос до сервера не дошел
+            sent_and_timed_out = (isinstance(e, asyncio.TimeoutError)
+                                  and not isinstance(e, aiohttp.ConnectionTimeoutError))
+            if attempt == HTTP_RETRIES or (not retry_timeouts and sent_and_timed_out):
+                raise
+            reason = str(e) or type(e).__name__
+        else:
+            if response.status not in RETRY_STATUSES or attempt == HTTP_RETRIES:
+                return response
+            reason = f"status {response.status}"
+            response.release()
+        delay = 2 ** attempt + random.random()
+        logger.warning("Request to %s failed (%s), retrying in %.1f s.", url, reason, delay)
+        await asyncio.sleep(delay)
 
 
 ### Парсинг вакансии (сырые данные)
 
-def parse_vacancy_page(vacancy_id: int) -> str:
+def is_main_block_class(value) -> bool:
+    # SoupStrainer сравнивает строку атрибута целиком, а у блока может быть несколько классов
+    if value is None:
+        return False
+    classes = value.split() if isinstance(value, str) else value
+    return "vacancy-full-content" in classes
+
+
+MAIN_BLOCK_STRAINER = SoupStrainer("div", class_=is_main_block_class)
+
+
+async def parse_vacancy_page(session: aiohttp.ClientSession, vacancy_id: int) -> tuple:
+    # (заголовок, сырой текст); None - вакансии нет;
+    # исключение - временная ошибка, которую не устранили повторы
     url = VACANCY_BASE_URL + str(vacancy_id)
-    print(f"Requesting vacancy page: {url}")
-    try:
-        response = requests.get(url, timeout=30)
-    except Exception as e:
-        print(f"Error requesting URL {url}: {e}")
-        logger.error(f"Error requesting URL {url}: {e}")
+    logger.debug("Requesting vacancy page: %s", url)
+    response = await request_with_retry(
+        session, "GET", url, SCRAPE_LIMITER, timeout=aiohttp.ClientTimeout(total=30)
+    )
+    async with response:
+        # Тело дочитываем целиком в любом случае, в том числе для 404:
+        # иначе aiohttp закроет соединение вместо возврата в пул
+        html = await response.read()
+        status = response.status
+        content_type = response.headers.get("Content-Type", "")
+        charset = response.charset
+    if status in RETRY_STATUSES:
+        raise Exception(f"Error requesting URL {url}: status {status}")
+    if status != 200:
+        logger.debug("Vacancy ID %s not found (status %s).", vacancy_id, status)
         return None
-
-    if response.status_code != 200:
-        print(f"Vacancy ID {vacancy_id} not found (status {response.status_code}).")
+    if "html" not in content_type:
+        logger.debug("Vacancy ID %s: not an HTML page (%s).", vacancy_id, content_type)
         return None
 
-    soup = BeautifulSoup(response.text, "html.parser")
+    # Строим дерево только для блока вакансии, навигацию и скрипты пропускаем
+    soup = BeautifulSoup(html, "lxml", parse_only=MAIN_BLOCK_STRAINER, from_encoding=charset)
     main_block = soup.find("div", class_="vacancy-full-content")
     if not main_block:
-        print(f"Vacancy {vacancy_id}: main block not found.")
+        logger.debug("Vacancy %s: main block not found.", vacancy_id)
         return None
 
     h1 = main_block.find("h1")
     if not h1:
-        print(f"Vacancy {vacancy_id}: no <h1> found.")
+        logger.debug("Vacancy %s: no <h1> found.", vacancy_id)
         return None
     title = h1.get_text(strip=True)
-    print(f"Vacancy {vacancy_id} title: {title}")
+    logger.debug("Vacancy %s title: %s", vacancy_id, title)
 
     raw_text = main_block.get_text(separator="\n", strip=True)
     combined = f"Job Title: {title}\n" + raw_text
-    return combined
+    return title, combined
 
 
 ### Форматирование через DeepSeek
 
-async def format_vacancy_deepseek(raw_text: str) -> str:
-    url = "https://api.deepseek.com/v1/chat/completions"
-    headers = {"Authorization": f"Bearer {DEEPSEEK_API_KEY}"}
-    prompt = (
-        "You are an expert vacancy formatter. Your task is to process the following raw vacancy information and output "
-        "a single, beautifully formatted vacancy in English using plain text. You may use small emojis or emoticons to enhance the presentation.\n\n"
-        "DO NOT use any HTML tags or markdown formatting; use only newline characters for line breaks.\n\n"
-        "IMPORTANT: Normalize the job title exactly to one of the following: \n"
-        "Chief Officer, Master, 2nd Officer, 3rd Officer, Chief Engineer, 2nd Engineer, 3rd Engineer, 4th Engineer, Electrical Engineer, Bosun, Able Seaman, Ordinary Seaman, Fitter, Motorman, Wiper, Cook, Steward.\n\n"
-        "If the vacancy does not match any of these job titles, return an empty result (skip it).\n\n"
-        "Format the vacancy using the following template exactly:\n\n"
-        "<Job Title> on <Vessel Type> \n\n"
-        "Joining Date: <Joining Date>\n"
-        "Voyage Duration: <Voyage Duration>\n\n"
-        "🚢 Vessel Details:\n"
-        "• Type: <Vessel Type>\n"
-        "• Year Built: <Year Built>\n"
-        "• DWT: <DWT>\n"
-        "• Crew Composition: <Crew Composition>\n\n"
-        "📋 Requirements:\n"
-        "• English Proficiency: <English Proficiency>\n"
-        "• Age Limit: <Age Limit>\n"
-        "• Experience in Position: <Experience in Position>\n\n"
-        "💰 Compensation:\n"
-        "• Salary: <Salary>\n\n"
-        "📞 Contact Information:\n"
-        "• Phone: <Phone>\n"
-        "• Email: <Email> \n"
-        "• Recommended e-mail subject: <Subject> \n"
-        "• Recruitment Manager: <Manager Name>\n\n"
-        "👔 Employer: <Employer>\n\n"
-        "@SeajobsHub - подписаться"
-        "Return ONLY the final formatted text exactly as specified above, using newline characters for line breaks.\n\n"
-        "Raw vacancy information:\n"
-        f"{raw_text}\n\n"
-        "Return only the formatted text."
-    )
+DEEPSEEK_URL = "https://api.deepseek.com/v1/chat/completions"
+DEEPSEEK_HEADERS = {"Authorization": f"Bearer {DEEPSEEK_API_KEY}", "Accept": "application/json"}
+
+# Инструкции собираются один раз при импорте, в вызове подставляется только текст вакансии
+PROMPT_INSTRUCTIONS = (
+    "You are an expert vacancy formatter. Your task is to process the following raw vacancy information and output "
+    "a single, beautifully formatted vacancy in English using plain text. You may use small emojis or emoticons to enhance the presentation.\n\n"
+    "DO NOT use any HTML tags or markdown formatting; use only newline characters for line breaks.\n\n"
+    "IMPORTANT: Normalize the job title exactly to one of the following: \n"
+    "Chief Officer, Master, 2nd Officer, 3rd Officer, Chief Engineer, 2nd Engineer, 3rd Engineer, 4th Engineer, Electrical Engineer, Bosun, Able Seaman, Ordinary Seaman, Fitter, Motorman, Wiper, Cook, Steward.\n\n"
+    "If the vacancy does not match any of these job titles, return an empty result (skip it).\n\n"
+    "Format the vacancy using the following template exactly:\n\n"
+    "<Job Title> on <Vessel Type> \n\n"
+    "Joining Date: <Joining Date>\n"
+    "Voyage Duration: <Voyage Duration>\n\n"
+    "🚢 Vessel Details:\n"
+    "• Type: <Vessel Type>\n"
+    "• Year Built: <Year Built>\n"
+    "• DWT: <DWT>\n"
+    "• Crew Composition: <Crew Composition>\n\n"
+    "📋 Requirements:\n"
+    "• English Proficiency: <English Proficiency>\n"
+    "• Age Limit: <Age Limit>\n"
+    "• Experience in Position: <Experience in Position>\n\n"
+    "💰 Compensation:\n"
+    "• Salary: <Salary>\n\n"
+    "📞 Contact Information:\n"
+    "• Phone: <Phone>\n"
+    "• Email: <Email> \n"
+    "• Recommended e-mail subject: <Subject> \n"
+    "• Recruitment Manager: <Manager Name>\n\n"
+    "👔 Employer: <Employer>\n\n"
+    "@SeajobsHub - подписаться"
+    "Return ONLY the final formatted text exactly as specified above, using newline characters for line breaks.\n\n"
+)
+PROMPT_TEMPLATE = PROMPT_INSTRUCTIONS + (
+    "Raw vacancy information:\n"
+    "{raw}\n\n"
+    "Return only the formatted text."
+)
+# Несколько вакансий в одном запросе: инструкции оплачиваются один раз на пачку
+BATCH_PROMPT_TEMPLATE = PROMPT_INSTRUCTIONS + (
+    "Process EACH of the {count} raw vacancies below. They are separated by lines containing only "
+    f"{VACANCY_DELIMITER}.\n"
+    "Output exactly {count} results in the same order, separated by lines containing only "
+    f"{VACANCY_DELIMITER}. "
+    "If a vacancy must be skipped, leave its result empty but keep the separators.\n\n"
+    "Raw vacancies:\n"
+    "{vacancies}\n\n"
+    "Return only the formatted texts."
+)
+
+
+async def request_deepseek(session: aiohttp.ClientSession, prompt: str, max_tokens: int) -> str:
     data = {
         "model": "deepseek-chat",
         "messages": [{
             "role": "user",
             "content": prompt
         }],
-        "max_tokens": 1500
+        "max_tokens": max_tokens
     }
-    print("Sending raw vacancy to DeepSeek for formatting...")
-    loop = asyncio.get_running_loop()
+    # Генерация пачки идет дольше одиночного ответа, поэтому таймаут растет вместе с max_tokens
+    timeout = aiohttp.ClientTimeout(total=DEEPSEEK_TIMEOUT_PER_VACANCY * max_tokens / MAX_TOKENS_PER_VACANCY)
     try:
-        response = await loop.run_in_executor(
-            None, lambda: requests.post(url, json=data, headers=headers, timeout=60)
+        # Таймаут не повторяем: ответ мог быть сгенерирован и оплачен, а пачка все равно делится пополам
+        response = await request_with_retry(
+            session, "POST", DEEPSEEK_URL, DEEPSEEK_LIMITER, retry_timeouts=False,
+            json=data, headers=DEEPSEEK_HEADERS, timeout=timeout
         )
-    except Exception as e:
-        print(f"DeepSeek request error: {e}")
+        async with response:
+            if response.status == 200:
+                body = orjson.loads(await response.read())
+            else:
+                error_msg = f"DeepSeek API Error: {response.status} - {await response.text()}"
+                logger.error(error_msg)
+                raise Exception(error_msg)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("DeepSeek request error: %s", str(e) or type(e).__name__)
         raise
 
-    if response.status_code == 200:
-        formatted = response.json()["choices"][0]["message"]["content"].strip()
-        if not formatted:
-            print("DeepSeek returned an empty result (vacancy skipped).")
-        else:
-            print("Received formatted vacancy from DeepSeek.")
-        return formatted
+    return body["choices"][0]["message"]["content"].strip()
+
+
+async def format_vacancy_deepseek(session: aiohttp.ClientSession, raw_text: str) -> str:
+    logger.debug("Sending raw vacancy to DeepSeek for formatting...")
+    formatted = await request_deepseek(session, PROMPT_TEMPLATE.format(raw=raw_text), MAX_TOKENS_PER_VACANCY)
+    if not formatted:
+        logger.debug("DeepSeek returned an empty result (vacancy skipped).")
     else:
-        error_msg = f"DeepSeek API Error: {response.status_code} - {response.text}"
-        print(error_msg)
-        raise Exception(error_msg)
+        logger.debug("Received formatted vacancy from DeepSeek.")
+    return formatted
+
+
+class BatchMismatchError(ValueError):
+    """Ответ DeepSeek на пачку не делится на нужное число вакансий."""
+
+
+async def format_vacancies_deepseek(session: aiohttp.ClientSession, raw_texts: list) -> list:
+    # Возвращает список той же длины: текст либо исключение для вакансии, которую не удалось обработать.
+    # Пачку делим пополам, только если ответ не делится на нужное число частей или не успел
+    # сгенерироваться; ошибки HTTP и сети (401, 429/5xx после повторов) относятся ко всей пачке.
+    if len(raw_texts) == 1:
+        try:
+            return [await format_vacancy_deepseek(session, raw_texts[0])]
+        except Exception as e:
+            return [e]
+
+    logger.debug("Sending %s raw vacancies to DeepSeek in one request...", len(raw_texts))
+    prompt = BATCH_PROMPT_TEMPLATE.format(
+        count=len(raw_texts),
+        vacancies=f"\n{VACANCY_DELIMITER}\n".join(raw_texts)
+    )
+    max_tokens = min(MAX_TOKENS_PER_VACANCY * len(raw_texts), DEEPSEEK_MAX_TOKENS)
+    try:
+        content = await request_deepseek(session, prompt, max_tokens)
+        parts = [part.strip() for part in content.split(VACANCY_DELIMITER)]
+        if len(parts) != len(raw_texts):
+            raise BatchMismatchError(f"expected {len(raw_texts)} results, got {len(parts)}")
+        return parts
+    except (BatchMismatchError, asyncio.TimeoutError) as e:
+        logger.warning("DeepSeek batch of %s vacancies failed (%s), splitting it.",
+                       len(raw_texts), str(e) or type(e).__name__)
+    except Exception as e:
+        logger.error("DeepSeek batch of %s vacancies failed: %s", len(raw_texts), e)
+        return [e] * len(raw_texts)
+
+    middle = len(raw_texts) // 2
+    left, right = await asyncio.gather(
+        format_vacancies_deepseek(session, raw_texts[:middle]),
+        format_vacancies_deepseek(session, raw_texts[middle:])
+    )
+    return left + right
+
+
+async def format_vacancies(session: aiohttp.ClientSession, conn: sqlite3.Connection, raw_texts: list) -> list:
+    # Результат для каждой вакансии: пара (текст, топик) либо исключение.
+    # Повторно не отправляем в DeepSeek тот же сырой текст (перезапуск, повторная проверка ID)
+    shas = [hashlib.sha256(raw_text.encode()).hexdigest() for raw_text in raw_texts]
+    async with DB_LOCK:  # db_writer может писать через то же соединение из другого потока
+        results = [get_cached_format(conn, sha) for sha in shas]
+    for sha, cached in zip(shas, results):
+        if cached is not None:
+            logger.debug("Using cached DeepSeek result %s.", sha[:12])
+
+    misses = [index for index, cached in enumerate(results) if cached is None]
+    batches = [misses[i:i + DEEPSEEK_BATCH_SIZE] for i in range(0, len(misses), DEEPSEEK_BATCH_SIZE)]
+    formatted_batches = await asyncio.gather(
+        *[format_vacancies_deepseek(session, [raw_texts[index] for index in batch]) for batch in batches]
+    )
+
+    cache_rows = []
+    for batch, formatted_batch in zip(batches, formatted_batches):
+        for index, formatted in zip(batch, formatted_batch):
+            if isinstance(formatted, Exception):
+                results[index] = formatted
+                continue
+            topic_id = choose_topic(formatted) if formatted else 0
+            cache_rows.append((shas[index], formatted, topic_id))
+            results[index] = (formatted, topic_id)
+
+    # Все новые ответы - одной транзакцией и вне event loop, как в db_writer
+    if cache_rows:
+        async with DB_LOCK:
+            await asyncio.to_thread(save_cached_formats, conn, cache_rows)
+    return results
 
 
 ### Определение топика для вакансии
 
 def choose_topic(formatted_text: str) -> int:
-    # Берем первую строку отформатированного текста для сопоставления
-    first_line = formatted_text.strip().split("\n", 1)[0].strip()
-    lower_line = first_line.lower()
-    print(f"First line for topic matching: '{lower_line}'")
-    for keyword, topic_id in TOPIC_ID_MAPPING.items():
-        if keyword in lower_line:
-            print(f"Matched keyword '{keyword}', topic: {topic_id}")
-            return topic_id
-    print("No matching topic found.")
+    # Берем первую строку отформатированного текста для сопоставления (без split и лишних копий)
+    lower_line = formatted_text.lstrip().partition("\n")[0].rstrip().lower()
+    logger.debug("First line for topic matching: '%s'", lower_line)
+    # search пробует позицию 0 первой, так что название в начале строки находится сразу,
+    # а эмодзи перед названием не мешает
+    match = TOPIC_PATTERN.search(lower_line)
+    if match:
+        keyword = match.group(0)
+        topic_id = TOPIC_ID_MAPPING[keyword]
+        logger.debug("Matched keyword '%s', topic: %s", keyword, topic_id)
+        return topic_id
+    logger.debug("No matching topic found.")
     return 0
 
 
+def is_relevant_title(title: str) -> bool:
+    # Вакансии с явно неподходящей должностью не отправляем в DeepSeek;
+    # незнакомый заголовок отправляем - пусть DeepSeek решает сам
+    lower_title = title.lower()
+    if TITLE_PATTERN.search(lower_title):
+        return True
+    return UNRELATED_TITLE_PATTERN.search(lower_title) is None
+
+
 ### Фоновая задача проверки вакансий
 
+async def probe_vacancies(session: aiohttp.ClientSession, ids: range, semaphore: asyncio.Semaphore,
+                          failed_attempts: dict) -> list:
+    # Параллельно запрашиваем страницы вакансий, не более PROBE_CONCURRENCY одновременно
+    stop_at = None  # ID с ошибкой, которая остановит цикл: страницы выше него уже не запрашиваем
+
+    async def fetch(vacancy_id: int):
+        nonlocal stop_at
+        async with semaphore:
+            if stop_at is not None and vacancy_id > stop_at:
+                return None  # результат не используется, check_new_vacancies остановится раньше
+            logger.debug("Checking vacancy ID: %s", vacancy_id)
+            try:
+                return await parse_vacancy_page(session, vacancy_id)
+            except Exception:
+                if failed_attempts.get(vacancy_id, 0) + 1 < MAX_FAILED_CYCLES:
+                    stop_at = vacancy_id if stop_at is None else min(stop_at, vacancy_id)
+                raise
+
+    tasks = [asyncio.create_task(fetch(vacancy_id)) for vacancy_id in ids]
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def publish_vacancy(context: ContextTypes.DEFAULT_TYPE, vacancy_id: int, result) -> bool:
+    # result - пара (текст, топик) либо исключение из format_vacancies.
+    # Вызывающий код помечает ID обработанным независимо от результата.
+    if isinstance(result, Exception):
+        logger.error("Error formatting vacancy ID %s: %s", vacancy_id, result)
+        return False
+    formatted_vacancy, topic_id = result
+    if not formatted_vacancy:
+        logger.info("Vacancy ID %s: DeepSeek returned empty result. Skipping.", vacancy_id)
+        return False
+    logger.debug("Formatted vacancy for ID %s:\n%s", vacancy_id, formatted_vacancy)
+    logger.info("Formatted vacancy received from DeepSeek.")
+
+    if topic_id == 0:
+        logger.info("Vacancy ID %s: Could not determine topic. Skipping.", vacancy_id)
+        return False
+
+    try:
+        await context.bot.send_message(
+            chat_id=TARGET_CHAT_ID,
+            text=formatted_vacancy,
+            message_thread_id=topic_id
+        )
+        logger.info("Sent vacancy ID %s to topic %s.", vacancy_id, topic_id)
+    except Exception as e:
+        logger.error("Error sending vacancy ID %s: %s", vacancy_id, e)
+
+    return True
+
+
 async def check_new_vacancies(context: ContextTypes.DEFAULT_TYPE):
-    print("Starting vacancy check...")
     logger.info("Starting vacancy check...")
-    last_id = get_last_processed_id()
+    session = context.bot_data["http"]
+    conn = context.bot_data["db"]
+    semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+    # Сколько циклов подряд ID не удалось проверить из-за временной ошибки
+    failed_attempts = context.bot_data.setdefault("failed_attempts", {})
+    # Дожидаемся записи ID прошлого цикла, иначе начнем с устаревшего last_id
+    await DB_WRITE_QUEUE.join()
+    last_id = get_last_processed_id(conn)
+    for vacancy_id in [vacancy_id for vacancy_id in failed_attempts if vacancy_id <= last_id]:
+        del failed_attempts[vacancy_id]
     current_id = last_id + 1
     new_count = 0
     missing_count = 0
-    max_missing = 10  # Если подряд не найдено 10 вакансий, останавливаем цикл
-
-    while missing_count < max_missing:
-        print(f"Checking vacancy ID: {current_id}")
-        raw_vacancy = parse_vacancy_page(current_id)
-        if raw_vacancy is None:
-            print(f"Vacancy ID {current_id} not found. Skipping.")
-            logger.info(f"Vacancy ID {current_id} not found. Skipping.")
-            # НЕ сохраняем отсутствующий ID, чтобы он мог быть проверен в следующий раз
-            current_id += 1
-            missing_count += 1
-            continue
-        else:
+    failed = False  # Временная ошибка: дальше этого ID в текущем цикле не идем
+
+    while missing_count < MAX_MISSING and not failed:
+        # Этап 1: параллельно проверяем пачку ID
+        ids = range(current_id, current_id + PROBE_BATCH_SIZE)
+        results = await probe_vacancies(session, ids, semaphore, failed_attempts)
+        current_id = ids[-1] + 1
+
+        # Идем по ID по порядку до первой серии из MAX_MISSING пропусков подряд
+        hits = []
+        for vacancy_id, raw_vacancy in zip(ids, results):
+            if isinstance(raw_vacancy, Exception):
+                attempts = failed_attempts.get(vacancy_id, 0) + 1
+                if attempts < MAX_FAILED_CYCLES:
+                    # Не считаем пропуском: ID будет проверен заново в следующем цикле
+                    logger.error("Error checking vacancy ID %s (attempt %s of %s): %s",
+                                 vacancy_id, attempts, MAX_FAILED_CYCLES, raw_vacancy)
+                    failed_attempts[vacancy_id] = attempts
+                    failed = True
+                    break
+                # ID стабильно отвечает ошибкой - считаем его отсутствующим, чтобы сканер шел дальше.
+                # Счетчик оставляем, чтобы в следующих циклах этот ID сразу считался пропуском
+                logger.error("Error checking vacancy ID %s in %s cycles, treating it as missing: %s",
+                             vacancy_id, attempts, raw_vacancy)
+                failed_attempts[vacancy_id] = attempts
+                raw_vacancy = None
+            else:
+                failed_attempts.pop(vacancy_id, None)
+            if raw_vacancy is None:
+                logger.info("Vacancy ID %s not found. Skipping.", vacancy_id)
+                # НЕ сохраняем отсутствующий ID, чтобы он мог быть проверен в следующий раз
+                missing_count += 1
+                if missing_count >= MAX_MISSING:
+                    break
+                continue
             missing_count = 0  # сброс, если вакансия найдена
+            title, raw_text = raw_vacancy
+            hits.append((vacancy_id, title, raw_text))
 
-        try:
-            formatted_vacancy = await format_vacancy_deepseek(raw_vacancy)
-            if not formatted_vacancy:
-                print(f"Vacancy ID {current_id}: DeepSeek returned empty result. Skipping.")
-                logger.info(f"Vacancy ID {current_id}: DeepSeek returned empty result. Skipping.")
-                save_processed_id(current_id)
-                current_id += 1
-                continue
-            print(f"Formatted vacancy for ID {current_id}:\n{formatted_vacancy}")
-            logger.info("Formatted vacancy received from DeepSeek.")
-        except Exception as e:
-            print(f"Error formatting vacancy ID {current_id}: {e}")
-            logger.error(f"Error formatting vacancy ID {current_id}: {e}")
-            save_processed_id(current_id)
-            current_id += 1
-            continue
-
-        topic_id = choose_topic(formatted_vacancy)
-        if topic_id == 0:
-            print(f"Vacancy ID {current_id}: Could not determine topic. Skipping.")
-            logger.info(f"Vacancy ID {current_id}: Could not determine topic. Skipping.")
-            save_processed_id(current_id)
-            current_id += 1
-            continue
+        # Этап 2: форматируем через DeepSeek пачками (пачки идут параллельно)
+        # только вакансии, заголовок которых похож на одну из нужных должностей
+        relevant = [raw_text for _, title, raw_text in hits if is_relevant_title(title)]
+        formatted = iter(await format_vacancies(session, conn, relevant))
 
-        try:
-            await context.bot.send_message(
-                chat_id=TARGET_CHAT_ID,
-                text=formatted_vacancy,
-                message_thread_id=topic_id
-            )
-            print(f"Sent vacancy ID {current_id} to topic {topic_id}.")
-            logger.info(f"Sent vacancy ID {current_id} to topic {topic_id}.")
-        except Exception as e:
-            print(f"Error sending vacancy ID {current_id}: {e}")
-            logger.error(f"Error sending vacancy ID {current_id}: {e}")
+        # Этап 3: публикуем по порядку ID
+        for vacancy_id, title, _ in hits:
+            if not is_relevant_title(title):
+                logger.info("Vacancy ID %s: title '%s' names an unrelated position. Skipping.", vacancy_id, title)
+            elif await publish_vacancy(context, vacancy_id, next(formatted)):
+                new_count += 1
+            DB_WRITE_QUEUE.put_nowait(vacancy_id)
+
+    logger.info("Vacancy check complete. %s new vacancies processed.", new_count)
 
-        save_processed_id(current_id)
-        new_count += 1
-        current_id += 1
 
-    print(f"Vacancy check complete. {new_count} new vacancies processed.")
-    logger.info(f"Vacancy check complete. {new_count} new vacancies processed.")
+SCRAPE_LOCK = asyncio.Lock()  # Одновременно выполняется только одна проверка вакансий
+
+
+class ScrapeResult(enum.Enum):
+    COMPLETED = "completed"
+    ALREADY_RUNNING = "already running"
+    TIMED_OUT = "timed out"
+
+
+async def run_scrape(context: ContextTypes.DEFAULT_TYPE) -> ScrapeResult:
+    # Если предыдущая проверка еще идет, новый запуск ничего не делает
+    if SCRAPE_LOCK.locked():
+        logger.info("Previous vacancy check is still running, skipping.")
+        return ScrapeResult.ALREADY_RUNNING
+    async with SCRAPE_LOCK:
+        try:
+            await asyncio.wait_for(check_new_vacancies(context), timeout=SCRAPE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("Vacancy check exceeded %s seconds and was cancelled.", SCRAPE_TIMEOUT)
+            return ScrapeResult.TIMED_OUT
+    return ScrapeResult.COMPLETED
 
 
 ### Команды для бота
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    print("Received /start command.")
+    logger.info("Received /start command.")
     await update.message.reply_text("Vacancy scraper bot is running.")
 
 
 async def scrape_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    print("Received /scrape command. Starting vacancy check manually.")
-    await check_new_vacancies(context)
-    await update.message.reply_text("Vacancy check completed.")
+    logger.info("Received /scrape command. Starting vacancy check manually.")
+    result = await run_scrape(context)
+    if result is ScrapeResult.ALREADY_RUNNING:
+        await update.message.reply_text("Vacancy check is already running.")
+    elif result is ScrapeResult.TIMED_OUT:
+        await update.message.reply_text(
+            f"Vacancy check took longer than {SCRAPE_TIMEOUT} seconds and was cancelled. "
+            "It will resume from the last saved vacancy."
+        )
+    else:
+        await update.message.reply_text("Vacancy check completed.")
 
 
 # Функция для автоматического запуска команды /scrape каждые 60 секунд
 async def scheduled_scrape(context: ContextTypes.DEFAULT_TYPE):
-    print("Scheduled scrape triggered.")
-    await check_new_vacancies(context)
+    logger.debug("Scheduled scrape triggered.")
+    await run_scrape(context)
+
+
+### Жизненный цикл приложения
+
+def orjson_dumps(obj) -> str:
+    # aiohttp ждет от json_serialize строку, orjson возвращает bytes
+    return orjson.dumps(obj).decode()
+
+
+async def post_init(app):
+    # Общая HTTP-сессия: keep-alive и пул соединений для ukrcrewing и DeepSeek
+    app.bot_data["http"] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=50, limit_per_host=20, ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=60),
+        # Ответы приходят сжатыми, aiohttp распаковывает их сам (auto_decompress)
+        headers={"Accept-Encoding": "gzip, deflate"},
+        json_serialize=orjson_dumps,
+    )
+    logger.info("HTTP session is ready.")
+    app.bot_data["db_writer"] = asyncio.create_task(db_writer(app.bot_data["db"]))
+
+
+async def post_shutdown(app):
+    session = app.bot_data.pop("http", None)
+    if session is not None:
+        await session.close()
+    logger.info("HTTP session closed.")
+    writer = app.bot_data.pop("db_writer", None)
+    if writer is not None:
+        await DB_WRITE_QUEUE.join()
+        writer.cancel()
+    conn = app.bot_data.pop("db", None)
+    if conn is not None:
+        conn.close()
+    logger.info("Database connection closed.")
 
 
 ### Основной запуск бота
 
 def main():
-    create_table()
-    print("Database is ready.")
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    conn = open_db()
+    create_table(conn)
+    logger.info("Database is ready.")
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    app.bot_data["db"] = conn
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("scrape", scrape_command))
 
     # Автоматическая проверка вакансий каждые 60 секунд, вызывая scheduled_scrape
     app.job_queue.run_repeating(scheduled_scrape, interval=CHECK_INTERVAL, first=0)
 
-    print("Bot is running. Waiting for commands and scheduled vacancy checks...")
     logger.info("Bot is running. Waiting for commands and scheduled vacancy checks...")
     app.run_polling()
 